@@ -8,11 +8,18 @@ from tensorflow.python.framework import ops
 from matplotlib import pyplot as plt
 from matplotlib import image
 from PIL import Image
-from os import listdir, getcwd
+from os import listdir, getcwd, cpu_count, makedirs, path, environ
+from multiprocessing import shared_memory, get_context
+from concurrent.futures import ProcessPoolExecutor
+import sqlite3
+import json
 import pandas as pd
 from datetime import datetime
 datetime.now()
 
+QUANTIZED_CHUNK = 512 # number of input features per exact float32 matmul of 'quantized_forward'.
+BLAS_THREADS_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS') # environment variables limiting the BLAS threads.
+
 # 01 ________________________________________________________________________________________________________________________________________________________________
 
 def prepare_image_data(images_path, resize = 64, label_tag = 1, show_rejected_images = False):
@@ -255,14 +262,16 @@ def predict_sample(sample_path, w, b):
 
 def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure = [5, 3, 1], iterations = 1000, alpha = 0.001,
                   lambd = 0, dropout_layers = [], keep_prob = 1, beta1 = 0.9, beta2 = 0.999, epsilon = 1e-8,
-                  print_cost = True, print_every = 500, show_plots = True, seed = 0):
+                  print_cost = True, print_every = 500, show_plots = True, seed = 0, augment = None, init_model = None, frozen_layers = 0,
+                  keep_optimizer_state = False, train_indices = None):
     '''
     An 'L' deep neural network model with regularization parameters for L2 and Dropout.
     
     Arguments:
         X: Features array of shape (number of features, number of examples).
         Y: Labels array of shape (1, number of examples).
-        X_test: same as X used for testing.
+        X_test: same as X used for testing. When 'augment' is given, it may be either the un-flattened uint8 images, flattened and standardized here as in
+                'prepare_image_arrays', or the already flattened and standardized array.
         Y_test: same as Y used for testing.
         layer_structure: A list of the number of nodes per hidden layer, so len(layer_structure) = number of hidden layers.
         iterations: number of epochs.
@@ -273,6 +282,15 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
         print_cost: If Ture, prints the cost and training accuracy every specific number of iterations.
         print_every: The number of iterations before printing the cost and training accuracy (if print_cost == True)
         show_plots: If True, plots and shows costs over iterations.
+        augment: A dictionary of keyword arguments for 'augment_batch' (may be empty) to augment every mini-batch on the fly, None by default for no augmentation.
+                 When given, X must be the un-flattened uint8 images array of shape (number of examples, hight, width, 3), the output of merge_shuffle_split funtion.
+        init_model: A dictionary, a previous model with the same structure outputed by this function (or 'load_model'), to continue training from its parameters,
+                    Adam optimizer state and step counter, e.g. on newly appended data only. None by default for a new random initialization.
+        frozen_layers: The number of first layers to be kept unchanged (fine-tuning), their gradients are not calculated. 0 by default.
+        keep_optimizer_state: If True, the Adam optimizer state ('Adam V', 'Adam S' and 'Adam Counter') is kept in model_summary to warm start from it later.
+                              False by default since it doubles the size of the summary.
+        train_indices: A 1D array of the examples of X and Y to train on, gathered one mini-batch at a time so X is never copied as a whole (e.g. a shared
+                       array). None by default to train on all of X.
         
     Returns:
         model_summary: A dictionary with varoius model information.
@@ -280,7 +298,12 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
     np.random.seed(seed)
     start = datetime.now() # to measure training time (start).
     model_structure = layer_structure.copy() # to include the inpout layer of shape (X.shape[0], number of images / examples).
-    model_structure.insert(0, X.shape[0]) # including the input layer and its dimensions.
+    if augment is None:
+        model_structure.insert(0, X.shape[0]) # including the input layer and its dimensions.
+    else:
+        model_structure.insert(0, int(np.prod(X.shape[1:]))) # the number of features of the flattened images.
+        if np.ndim(X_test) == 4: # the test images are not augmented, only flattened and standardized.
+            X_test = X_test.reshape(X_test.shape[0], -1).T / 255.
     num_layers = len(model_structure) # total number of layers in the model including the input layer (layer 0).
     L = num_layers - 1 # number of hidden layers in the model.
     
@@ -298,6 +321,19 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
         
         S['dW' + str(l)] = np.zeros((P['W' + str(l)].shape)) # initializing RMSProp variables for the wieghtes.
         S['db' + str(l)] = np.zeros((P['b' + str(l)].shape)) # initializing RMSProp variables for the baises.
+
+    adam_counter = 1 # the Adam step counter, continued from init_model if given.
+    if init_model is not None: # warm start, replacing the initialized parameters and optimizer state by the ones of init_model (copied).
+        if tuple(init_model['Model Structure']) != tuple(model_structure):
+            raise ValueError('init_model structure {} does not match the model structure {}.'.format(tuple(init_model['Model Structure']), tuple(model_structure)))
+        P = {key: np.array(value) for key, value in init_model['P'].items()}
+        if {'Adam V', 'Adam S', 'Adam Counter'} <= set(init_model): # otherwise (state not kept or not loaded) V & S start zeroed with the counter at 1.
+            V = {key: np.array(value) for key, value in init_model['Adam V'].items()}
+            S = {key: np.array(value) for key, value in init_model['Adam S'].items()}
+            adam_counter = init_model['Adam Counter']
+
+    if not 0 <= frozen_layers < L:
+        raise ValueError('frozen_layers must be from 0 to {}, got {}.'.format(L - 1, frozen_layers))
                 
     # Dictionaries to run and save the forward and backward propagation results:
     Z = dict() # linear forward pass.
@@ -312,12 +348,17 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
     ## Forward Propagation:
     X_train = X
     Y_train = Y
-    adam_counter = 1
     for i in range(iterations): # over each iteration.
         X = X_train
         Y = Y_train
         
-        mini_batches_list = create_rand_mini_batches(X_train, Y_train, mini_batch_size, seed = seed)
+        if train_indices is not None:
+            mini_batches_list = create_index_mini_batches(X_train, Y_train, train_indices, mini_batch_size, seed = seed + i, augment = augment) # seeded per epoch.
+        elif augment is None:
+            mini_batches_list = create_rand_mini_batches(X_train, Y_train, mini_batch_size, seed = seed)
+        else:
+            mini_batches_list = create_augmented_mini_batches(X_train, Y_train, mini_batch_size, seed = seed + i, augment = augment) # seeded per epoch.
+        num_mini_batches = int(np.ceil((Y_train.shape[1] if train_indices is None else len(train_indices)) / mini_batch_size))
 
         for mini_batch in mini_batches_list: # looping over mini-batches.
             X, Y = mini_batch # unpack first mini-batch into X and Y.
@@ -363,11 +404,11 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
             dA['dA' + str(L)] = - (np.divide(Y, A['A' + str(L)]) - np.divide(1 - Y, 1 - A['A' + str(L)])) # initializing backward propagation.
             dZ['dZ' + str(L)] = dA['dA' + str(L)] * A['A' + str(L)] * (1 - A['A' + str(L)]) # sigmoid activation backwared
             
-            for l in reversed(range(1, num_layers)): # for every layer in the model, going last to first, calculate:
+            for l in reversed(range(frozen_layers + 1, num_layers)): # for every trainable layer in the model, going last to first, calculate:
                 dP['dW' + str(l)] = np.dot(dZ['dZ' + str(l)], A['A' + str(l - 1)].T) / mini_batch_m + (P['W' + str(l)] * lambd / mini_batch_m)# Ws gradients with regularization.
                 dP['db' + str(l)] = np.sum(dZ['dZ' + str(l)], axis = 1, keepdims = True) / mini_batch_m # bs gradients.
                 
-                if l > 1: # As long as this is not the first layer, then calcualte:
+                if l > frozen_layers + 1: # As long as this is not the first trainable layer, then calcualte:
                     dA['dA' + str(l - 1)] = np.dot(P['W' + str(l)].T, dZ['dZ' + str(l)]) # Relu activations gradients.
                     
                     if (len(dropout_layers) != 0) and (keep_prob < 1.0) and (l - 1 in dropout_layers):
@@ -379,7 +420,7 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
             Vc = dict() # corrected momentum parameters dictionary, used to store the exponentially moving averages of the gradients. 
             Sc = dict() # corrected RMSProp parameters dictionary, used to store the exponentially moving averages of the squared gradients.
         ## Updating the parameters:    
-            for l in range(1, num_layers): # for every hidden layer in the model:
+            for l in range(frozen_layers + 1, num_layers): # for every trainable hidden layer in the model:
                 V['dW' + str(l)] = beta1 * V['dW' + str(l)] + (1 - beta1) * dP['dW' + str(l)]
                 V['db' + str(l)] = beta1 * V['db' + str(l)] + (1 - beta1) * dP['db' + str(l)]
                 
@@ -427,7 +468,7 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
     print('Test Accuracy: {}%'.format(test_acc)) # printing test accuracy.
     
     if show_plots: # if 'show_plots' argument is set to True, show the costs plots:
-        sub_costs = [costs[i] for i in range(len(costs)) if i % len(mini_batches_list) == 0] # list of costs resulting from full iterations.
+        sub_costs = [costs[i] for i in range(len(costs)) if i % num_mini_batches == 0] # list of costs resulting from full iterations.
         plt.plot(np.squeeze(sub_costs)) # plot costs resulting from full iterations.
 #         plt.plot(np.squeeze(costs)) # ploting the costs over iterations.
         plt.ylabel('cost') # labeling the y axis.
@@ -444,7 +485,9 @@ def deep_nn_model(X, Y, X_test, Y_test, mini_batch_size = 128, layer_structure =
                      'Iterations': iterations, 'alpha': alpha,
                      'P': P, 'Costs': costs, 'Train Accuracy': train_acc, 'Test Accuracy': test_acc, 'Dropout Masks': D,
                      'Regularization Lambd': lambd, 'Keep Prob.': keep_prob, 'Dropout Layers': tuple(sorted(dropout_layers)),
-                     'Mini Batch Size': mini_batch_size, 'beta1': beta1, 'beta2': beta2, 'epsilon': epsilon}
+                     'Mini Batch Size': mini_batch_size, 'beta1': beta1, 'beta2': beta2, 'epsilon': epsilon, 'Frozen Layers': frozen_layers}
+    if keep_optimizer_state:
+        model_summary.update({'Adam V': V, 'Adam S': S, 'Adam Counter': adam_counter})
     
     return model_summary # the dictionary with model summary information returned.
 
@@ -517,7 +560,8 @@ def random_image_check(num_images, set_x, set_y):
 def deep_nn_model_exp(train_set_x, train_set_y, test_set_x, test_set_y, mini_batch_size = 128,
                       layer_structures = [[1]], epochs_range = (1000, 3000), epochs_sets = 1, alpha_range = (0.001, 0.005), alpha_sets = 1,
                       lambd = 0.0, dropout_layers = [], keep_prob = 1.0, beta1 = 0.9, beta2 = 0.999, epsilon = 1e-8,
-                      print_cost = True, print_every = 500, show_plots = True, seed = 0):
+                      print_cost = True, print_every = 500, show_plots = True, seed = 0, augment = None, init_model = None, frozen_layers = 0,
+                      keep_optimizer_state = False):
     '''
     The function performs iterative application of the 'deep_nn_model' funciton over the number of given epochs, for every given structure, for every given alpha
     and returns a list of the resulted models where each contains full information about the model parameters and hayperparameters...etc. For full details on the
@@ -526,7 +570,7 @@ def deep_nn_model_exp(train_set_x, train_set_y, test_set_x, test_set_y, mini_bat
     Arguments:
         train_set_x: Features set to be used for training, outputed by 'prepare_image_arrays' function.
         train_set_y: Labels of 'train_set_x'.
-        test_set_x: Same as 'train_set_x' for testing.
+        test_set_x: Same as 'train_set_x' for testing. When 'augment' is given, either the un-flattened uint8 images or the flattened and standardized array.
         test_set_y: Labels of 'test_set_x'.
         layer_structures: A list of lists of intergers such that each is one model structure with 'len()' equaling the number of hidden layers in the model,
                             and each element being the number of neurons for layer it is indexing. Last element must be 1 as it is for the output layer.
@@ -540,6 +584,10 @@ def deep_nn_model_exp(train_set_x, train_set_y, test_set_x, test_set_y, mini_bat
         print_cost: A boolean, True to print the cost and train accuracy.
         print_every: An interger specifying after how many epochs the cost and train accuracy to be printed.
         show_plots: A boolean, True to print the cost and train accuracy.
+        augment: A dictionary of keyword arguments for 'augment_batch' to augment the mini-batches on the fly, check 'deep_nn_model' for details.
+        init_model: A previous model to continue training from for every sweep point, its structure must match every one of layer_structures.
+        frozen_layers: The number of first layers to be kept unchanged, check 'deep_nn_model' for details.
+        keep_optimizer_state: If True, every model keeps its Adam optimizer state, check 'deep_nn_model' for details.
         
     Returns:
         model_summary: A dictionary with varoius model information, check 'deep_nn_funciton' output for details.        
@@ -558,7 +606,8 @@ def deep_nn_model_exp(train_set_x, train_set_y, test_set_x, test_set_y, mini_bat
                 model = deep_nn_model(train_set_x, train_set_y, test_set_x, test_set_y, mini_batch_size = mini_batch_size,
                                       layer_structure = structure, iterations = int(iteration), alpha = alpha.round(6),
                                       lambd = lambd, dropout_layers = dropout_layers, keep_prob = keep_prob, beta1 = beta1, beta2 = beta2, epsilon = epsilon, 
-                                      print_cost = print_cost, print_every = print_every, show_plots = show_plots, seed = seed)
+                                      print_cost = print_cost, print_every = print_every, show_plots = show_plots, seed = seed, augment = augment,
+                                      init_model = init_model, frozen_layers = frozen_layers, keep_optimizer_state = keep_optimizer_state)
                 
                 models_list.append(model)
                 count += 1
@@ -747,15 +796,618 @@ def deep_nn_model_tf_predict(sample_path = None, resize = 100, par = None):
 
 # 25 ________________________________________________________________________________________________________________________________________________________________
 
+def quantize_model(model, calibration_set_x_orig, batch_size = 256):
+    '''
+    Given a model resulting from the 'deep_nn_model' function, the function returns an int8 quantized copy of its parameters for inference.
+    Each weights matrix is quantized per output neuron (row) with a symmetric scale, the biases are kept as float32. The ReLU activations of every hidden layer
+    are quantized to uint8 with a fixed scale calibrated on the maximum activation over the calibration set, so predictions do not depend on the batch.
+
+    Arguments:
+        model: A dictionary, the model to be quantized (output of 'deep_nn_model').
+        calibration_set_x_orig: A 4D uint8 array of shape (number images, hight, width, 3) to calibrate the activations scales with, e.g. train_set_x_orig.
+        batch_size: The number of calibration images to run the model on at once.
+
+    Returns:
+        q_model: A dictionary with the 'Model Structure' of the model, 'QP', the quantized parameters dictionary, where for every layer 'l': 'W' + str(l) is an
+                 int8 array, 'sW' + str(l) its float32 scales of shape (number of nodes, 1), 'b' + str(l) the float32 biases, and 'sA' + str(l) the scale of
+                 the layer activations (hidden layers only).
+    '''
+    num_layers = len(model['Model Structure'])
+    L = num_layers - 1
+    P = model['P']
+    QP = dict() # quantized parameters dictionary.
+
+    for l in range(1, num_layers):
+        W = P['W' + str(l)]
+        scale = np.max(np.abs(W), axis = 1, keepdims = True) / 127. # one scale per row so that the largest weight of each node maps to 127.
+        scale[scale == 0] = 1. # to avoid dividing by zero for all-zero rows.
+        QP['W' + str(l)] = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+        QP['sW' + str(l)] = scale.astype(np.float32)
+        QP['b' + str(l)] = P['b' + str(l)].astype(np.float32)
+
+    # Calibration, the max activation of every hidden layer using the float parameters:
+    A_max = np.zeros(num_layers)
+    for i in range(0, len(calibration_set_x_orig), batch_size):
+        A = calibration_set_x_orig[i: i + batch_size].reshape(-1, model['Model Structure'][0]).astype(np.float32) / 255.
+        for l in range(1, L):
+            A = np.maximum(0, np.dot(A, P['W' + str(l)].T.astype(np.float32)) + P['b' + str(l)].T)
+            A_max[l] = max(A_max[l], A.max())
+    for l in range(1, L):
+        QP['sA' + str(l)] = np.float32(max(A_max[l], 1e-8) / 255.)
+
+    q_model = {'Model Structure': model['Model Structure'], 'QP': QP}
+
+    return q_model
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def quantized_forward(set_x_orig, q_model, batch_size = 256):
+    '''
+    A forward pass using the int8 parameters of 'quantize_model' with int32 accumulation. The uint8 pixels are fed directly to the first layer in batches, and
+    the '/ 255.' standardization is folded into its scales. The ReLU activations of the following layers are quantized to uint8 with the calibrated scales.
+    The integer products run as float32 BLAS matmuls over chunks of 'QUANTIZED_CHUNK' input features, which are exact (512 * 255 * 127 < 2 ** 24), and
+    are accumulated as int32. Only the int8 weights are kept, each chunk of them is widened to float32 into one reused buffer per layer when it is used.
+
+    Arguments:
+        set_x_orig: A 4D uint8 array of shape (number images, hight, width, 3), as outputed by 'prepare_image_data' or 'merge_shuffle_split' functions.
+        q_model: A dictionary, the output of 'quantize_model' function.
+        batch_size: The number of images to convert and run at once.
+
+    Returns:
+        A_L: A float32 array of shape (1, number images) containing the sigmoid output of the model.
+    '''
+    num_layers = len(q_model['Model Structure'])
+    L = num_layers - 1
+    QP = q_model['QP']
+    m = len(set_x_orig)
+    A_L = np.empty((q_model['Model Structure'][L], m), dtype = np.float32)
+    W_buffers = [None] + [np.empty((QUANTIZED_CHUNK, q_model['Model Structure'][l]), dtype = np.float32) for l in range(1, num_layers)] # the widened chunks.
+
+    for i in range(0, m, batch_size):
+        A_q = set_x_orig[i: i + batch_size].reshape(-1, q_model['Model Structure'][0]).astype(np.float32) # (batch, features), uint8 values held in float32.
+        A_scale = np.float32(1 / 255.) # the standardization of 'prepare_image_arrays' function.
+
+        for l in range(1, num_layers):
+            W = QP['W' + str(l)]
+            Z = np.zeros((A_q.shape[0], W.shape[0]), dtype = np.int32)
+            for k in range(0, W.shape[1], QUANTIZED_CHUNK):
+                W_chunk = W_buffers[l][:min(QUANTIZED_CHUNK, W.shape[1] - k)]
+                np.copyto(W_chunk, W[:, k: k + QUANTIZED_CHUNK].T) # widening the int8 chunk to float32.
+                Z += np.dot(A_q[:, k: k + QUANTIZED_CHUNK], W_chunk).astype(np.int32) # int32 accumulation of the exact chunks.
+            Z = Z.astype(np.float32) * (QP['sW' + str(l)].T * A_scale) + QP['b' + str(l)].T # dequantizing the linear forward pass.
+
+            if l < L:
+                A_scale = QP['sA' + str(l)]
+                A_q = np.clip(np.round(np.maximum(0, Z) / A_scale), 0, 255) # ReLU quantized to uint8 values.
+            else:
+                A_L[:, i: i + batch_size] = (1 / (1 + np.exp(-Z))).T # sigmoid output.
+
+    return A_L
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def quantization_report(model, q_model, set_x_orig, set_y):
+    '''
+    Given a model and its quantized version, the function compares thier accuracy, agreement, parameters memory and inference time over the given set.
+    The quantized forward pass is timed against the float64 path of 'deep_nn_model_predict' (the full '/ 255.' array) and against a float32 forward pass over
+    the same uint8 batches, which shows what the int8 parameters gain over a plain float32 export.
+
+    Arguments:
+        model: A dictionary, the model outputed by 'deep_nn_model' function.
+        q_model: A dictionary, the output of 'quantize_model' for the same model.
+        set_x_orig: A 4D uint8 array of shape (number images, hight, width, 3), the output of merge_shuffle_split funtion.
+        set_y: The labels of set_x_orig of shape (1, number images).
+
+    Returns:
+        report: A dictionary with the float and quantized accuracies, their predictions agreement, the float64, float32 and quantized parameters size in
+                bytes, and the inference times with the speedups of the quantized forward pass.
+    '''
+    num_layers = len(model['Model Structure'])
+    L = num_layers - 1
+    P = model['P']
+    m = set_y.shape[1]
+
+    start = datetime.now() # to measure the float inference time (start).
+    A = prepare_image_arrays(set_x_orig)
+    for l in range(1, num_layers):
+        Z = np.dot(P['W' + str(l)], A) + P['b' + str(l)]
+        if l < L:
+            A = np.maximum(0, Z)
+        else:
+            A = 1 / (1 + np.exp(-Z))
+    Yhat_float = np.array((A > 0.5) * 1).reshape(1, m)
+    float_time = datetime.now() - start
+
+    P32 = {key: value.astype(np.float32) for key, value in P.items()} # the float32 export.
+    start = datetime.now() # to measure the float32 inference time (start).
+    for i in range(0, m, 256): # the same batches of 'quantized_forward' function.
+        A = set_x_orig[i: i + 256].reshape(-1, model['Model Structure'][0]).astype(np.float32) / np.float32(255.)
+        for l in range(1, num_layers):
+            Z = np.dot(A, P32['W' + str(l)].T) + P32['b' + str(l)].T
+            if l < L:
+                A = np.maximum(0, Z)
+    float32_time = datetime.now() - start
+
+    start = datetime.now() # to measure the quantized inference time (start).
+    Yhat_q = np.array((quantized_forward(set_x_orig, q_model) > 0.5) * 1).reshape(1, m)
+    quantized_time = datetime.now() - start
+
+    float_acc = (100 - np.mean(np.abs(Yhat_float - set_y)) * 100).round(4)
+    quantized_acc = (100 - np.mean(np.abs(Yhat_q - set_y)) * 100).round(4)
+
+    report = {'Float Accuracy': float_acc, 'Quantized Accuracy': quantized_acc,
+              'Predictions Agreement': (np.mean(Yhat_float == Yhat_q) * 100).round(4),
+              'Float Parameters Bytes': sum(p.nbytes for p in P.values()),
+              'Float32 Parameters Bytes': sum(p.nbytes for p in P32.values()),
+              'Quantized Parameters Bytes': sum(np.asarray(p).nbytes for p in q_model['QP'].values()),
+              'Float Inference Time': str(float_time), 'Float32 Inference Time': str(float32_time), 'Quantized Inference Time': str(quantized_time),
+              'Speedup vs Float': round(float_time / quantized_time, 2), 'Speedup vs Float32': round(float32_time / quantized_time, 2)}
+
+    for key, value in report.items():
+        print(key + ':', value)
+
+    return report
 
 # 26 ________________________________________________________________________________________________________________________________________________________________
 
+def augment_batch(batch_x_orig, seed, flip = True, max_shift = 4, brightness = 0.1, contrast = 0.1):
+    '''
+    Given a mini-batch of images, the function returns a randomly augmented copy of it using vectorized operations over the whole batch.
+
+    Arguments:
+        batch_x_orig: A 4D uint8 array of shape (batch size, hight, width, 3).
+        seed: The seed of the random augmentations.
+        flip: If True, each image is flipped horizontally with a probability of 0.5.
+        max_shift: The maximum number of pixels each image is shifted (cropped from an edge padded image) in any direction, 0 to disable.
+        brightness: The maximum brightness change as a fraction of the max pixel value of 255, 0 to disable.
+        contrast: The maximum contrast change as a fraction around the mean pixel value of each image, 0 to disable.
+
+    Returns:
+        batch_aug: A 4D uint8 array with the same shape of batch_x_orig.
+    '''
+    rng = np.random.RandomState(seed)
+    batch_m, hight, width = batch_x_orig.shape[:3]
+    batch_aug = batch_x_orig
+
+    if flip: # flipping half of the images horizontally.
+        flip_mask = rng.rand(batch_m) < 0.5
+        batch_aug = np.where(flip_mask[:, None, None, None], batch_aug[:, :, ::-1], batch_aug)
+
+    if max_shift > 0: # cropping a shifted window of every image out of the edge padded batch.
+        padded = np.pad(batch_aug, ((0, 0), (max_shift, max_shift), (max_shift, max_shift), (0, 0)), mode = 'edge')
+        shift_rows = rng.randint(0, 2 * max_shift + 1, batch_m)
+        shift_cols = rng.randint(0, 2 * max_shift + 1, batch_m)
+        rows = shift_rows[:, None] + np.arange(hight)
+        cols = shift_cols[:, None] + np.arange(width)
+        batch_aug = padded[np.arange(batch_m)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+    if brightness > 0 or contrast > 0: # jittering brightness and contrast per image.
+        brightness_shift = rng.uniform(-brightness, brightness, (batch_m, 1, 1, 1)).astype(np.float32) * 255
+        contrast_factor = rng.uniform(1 - contrast, 1 + contrast, (batch_m, 1, 1, 1)).astype(np.float32)
+        batch_float = batch_aug.astype(np.float32)
+        batch_mean = batch_float.mean(axis = (1, 2, 3), keepdims = True)
+        batch_float = (batch_float - batch_mean) * contrast_factor + batch_mean + brightness_shift
+        batch_aug = np.clip(batch_float, 0, 255).astype(np.uint8)
+
+    return batch_aug
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def create_augmented_mini_batches(set_x_orig, Y_train, mini_batch_size, seed, augment = None):
+    '''
+    A generator version of 'create_rand_mini_batches' for the un-flattened images. Only the shuffled indices are kept for the epoch, and every mini-batch
+    is gathered, augmented by 'augment_batch', flattened and standardized as in 'prepare_image_arrays' when it is yielded.
+
+    Arguments:
+        set_x_orig: A 4D uint8 array of shape (number images, hight, width, 3), the output of merge_shuffle_split funtion.
+        Y_train: The labels of set_x_orig of shape (number of classes, number images).
+        mini_batch_size: The number of examples per mini-batch.
+        seed: The seed of the shuffle and the augmentations of the epoch.
+        augment: A dictionary of keyword arguments passed to 'augment_batch', None by default for its default augmentations.
+
+    Yields:
+        mini_batch: A tuple (mini_batch_X, mini_batch_Y) where mini_batch_X is of shape (number of features, mini-batch size).
+    '''
+    m = Y_train.shape[1] # number of traning examples.
+    indices = np.random.RandomState(seed).permutation(m) # creating indices to shuffle the images for mini-batch creation.
+
+    for k, i in enumerate(range(0, m, mini_batch_size)):
+        batch_indices = indices[i: i + mini_batch_size]
+        batch_x_orig = augment_batch(set_x_orig[batch_indices], seed = [seed, k], **(augment or {})) # a different seed for every mini-batch of the epoch.
+        mini_batch_X = batch_x_orig.reshape(batch_x_orig.shape[0], -1).T / 255.
+        mini_batch_Y = Y_train[:, batch_indices]
+        yield (mini_batch_X, mini_batch_Y)
+
 
 # 27 ________________________________________________________________________________________________________________________________________________________________
 
+def stratified_split(class_pairs = None, manifest = None, validation_split = 0.2, k_folds = None, seed = 123):
+    '''
+    Given any number of pairs of images and thier labels, outputed by 'prepare_image_data' function, or a labeled manifest, the function returns stratified
+    train / test index arrays, or k folds of them, without copying the images. The indices refer to the images in the order of the given pairs, as if they were
+    concatenated, and can be gathered with the 'gather_images' function.
+
+    Arguments:
+        class_pairs: A list of tuples (images_array, labels_array), each pertaining to a certain class.
+        manifest: A list of tuples (image name, label), used instead of class_pairs when the images are not loaded. The labels may be numbers or class names.
+        validation_split: Percentage of validation/test set out of every class, between 0 and 1 exclusive, ignored if k_folds is given. Every class of two
+                          images or more keeps at least one image in both the train and the test sets.
+        k_folds: An integer of 2 or more, the number of folds to split every class into, None by default for a single train / test split. Every class must
+                 have at least k_folds images.
+        seed: The seed to be set for the random shuffle of every class.
+
+    Returns:
+        labels_array: A 2D array of shape (1, number of images) containing the labels of all images, as given.
+        splits: A list of tuples (train_indices, test_indices), one per fold (a single tuple if k_folds is None).
+    '''
+    if k_folds is not None and k_folds < 2:
+        raise ValueError('k_folds must be at least 2, got {}.'.format(k_folds))
+    if k_folds is None and not 0 < validation_split < 1:
+        raise ValueError('validation_split must be between 0 and 1 (exclusive), got {}.'.format(validation_split))
+
+    if class_pairs is not None:
+        labels_array = np.concatenate([labels for images, labels in class_pairs], axis = 1)
+    else:
+        labels_array = np.array([label for name, label in manifest]).reshape(1, -1)
+        if labels_array.dtype.kind in 'biuf': # numeric labels are kept as floats as in 'prepare_image_data' function.
+            labels_array = labels_array.astype(float)
+
+    rng = np.random.RandomState(seed)
+    classes, class_codes = np.unique(labels_array[0], return_inverse = True) # integer codes of the labels, whatever their type.
+    classes_indices = [rng.permutation(np.flatnonzero(class_codes == c)) for c in range(len(classes))] # shuffled indices of every class.
+
+    if k_folds is None:
+        test_sizes = [int(round(validation_split * len(class_indices))) for class_indices in classes_indices]
+        test_sizes = [min(max(size, 1), len(class_indices) - 1) if len(class_indices) > 1 else size # at least one test and one train image.
+                      for size, class_indices in zip(test_sizes, classes_indices)]
+        test_parts = [[class_indices[:size]] for size, class_indices in zip(test_sizes, classes_indices)]
+        if sum(test_sizes) == 0:
+            raise ValueError('The test set is empty, every class has a single image.')
+    else:
+        smallest_class = min(len(class_indices) for class_indices in classes_indices)
+        if smallest_class < k_folds:
+            raise ValueError('k_folds is {} but the smallest class has only {} images, some folds would miss it.'.format(k_folds, smallest_class))
+        test_parts = [np.array_split(class_indices, k_folds) for class_indices in classes_indices]
+
+    splits = list()
+    for fold in range(len(test_parts[0])):
+        test_indices = np.sort(np.concatenate([class_parts[fold] for class_parts in test_parts]))
+        train_mask = np.ones(labels_array.shape[1], dtype = bool)
+        train_mask[test_indices] = False
+        splits.append((np.flatnonzero(train_mask), test_indices))
+
+    print('Number of splits:', len(splits))
+    print('Train / Test sizes:', [(len(train_indices), len(test_indices)) for train_indices, test_indices in splits])
+
+    return labels_array, splits
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def gather_images(class_pairs, indices):
+    '''
+    Given the class pairs and some of the indices returned by 'stratified_split', the function returns only the indexed images, copied once.
+
+    Arguments:
+        class_pairs: The same list of tuples (images_array, labels_array) given to 'stratified_split'.
+        indices: A 1D array of indices of the images to be gathered.
+
+    Returns:
+        set_x_orig: A 4D array of shape (len(indices), hight, width, 3) containing the indexed images (yet to be standardized).
+    '''
+    offsets = np.cumsum([0] + [len(images) for images, labels in class_pairs]) # the first index of every class.
+    pair_numbers = np.searchsorted(offsets, indices, side = 'right') - 1 # the class pair of every index.
+    set_x_orig = np.empty((len(indices),) + class_pairs[0][0].shape[1:], dtype = class_pairs[0][0].dtype)
+
+    for p, (images, labels) in enumerate(class_pairs):
+        pair_mask = pair_numbers == p
+        set_x_orig[pair_mask] = images[indices[pair_mask] - offsets[p]]
+
+    return set_x_orig
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def create_index_mini_batches(X, Y, indices, mini_batch_size, seed, augment = None):
+    '''
+    A generator of the shuffled mini-batches of the examples of X and Y given by 'indices'. Only the indices are shuffled and every mini-batch is gathered
+    from X when it is yielded, so X is never copied as a whole.
+
+    Arguments:
+        X: Features array of shape (number of features, number of examples), or the un-flattened uint8 images array if augment is given.
+        Y: Labels array of shape (number of classes, number of examples).
+        indices: A 1D array of the examples to create the mini-batches from.
+        mini_batch_size: The number of examples per mini-batch.
+        seed: The seed of the shuffle and the augmentations of the epoch.
+        augment: A dictionary of keyword arguments passed to 'augment_batch', None by default for no augmentation.
+
+    Yields:
+        mini_batch: A tuple (mini_batch_X, mini_batch_Y) where mini_batch_X is of shape (number of features, mini-batch size).
+    '''
+    indices = np.random.RandomState(seed).permutation(indices) # shuffling the indices for mini-batch creation.
+
+    for k, i in enumerate(range(0, len(indices), mini_batch_size)):
+        batch_indices = indices[i: i + mini_batch_size]
+        if augment is None:
+            mini_batch_X = X[:, batch_indices]
+        else:
+            batch_x_orig = augment_batch(X[batch_indices], seed = [seed, k], **augment)
+            mini_batch_X = batch_x_orig.reshape(batch_x_orig.shape[0], -1).T / 255.
+        yield (mini_batch_X, Y[:, batch_indices])
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def _cross_validation_fold(args):
+    '''
+    Trains one fold of 'cross_validate_deep_nn' inside a worker process, against the data shared by the parent process.
+    '''
+    shm_name, shape, dtype, Y, fold, train_indices, test_indices, model_kwargs = args
+    shm = shared_memory.SharedMemory(name = shm_name)
+    X = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+    if model_kwargs.get('augment') is None: # only the test fold is copied, the training reads its mini-batches from the shared X.
+        X_test = X[:, test_indices]
+    else: # the shared data are the un-flattened images, the test set is flattened and standardized.
+        X_test = X[test_indices].reshape(len(test_indices), -1).T / 255.
+
+    model = deep_nn_model(X, Y, X_test, Y[:, test_indices], train_indices = train_indices, **model_kwargs)
+    model['Fold'] = fold
+    del X
+    shm.close()
+
+    return model
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def cross_validate_deep_nn(X, Y, splits, n_jobs = None, **model_kwargs):
+    '''
+    The function trains one 'deep_nn_model' per fold of 'splits' in parallel processes. X is placed once in shared memory, every worker trains from the
+    indices of its fold, gathering one mini-batch at a time from the shared X, and only copies its test fold. The folds metrics are aggregated into one
+    summary that can be passed with other models to the 'models_summary' function.
+    The workers are started with the 'spawn' method and their BLAS threads are limited to share the CPUs between them, so, on every platform, the calling
+    script must run this function under an "if __name__ == '__main__':" guard.
+
+    Arguments:
+        X: Features array of shape (number of features, number of examples), or the un-flattened uint8 images array if 'augment' is given in model_kwargs.
+        Y: Labels array of shape (1, number of examples).
+        splits: A list of tuples (train_indices, test_indices), the output of 'stratified_split' function.
+        n_jobs: The number of worker processes, None by default for the smaller of the number of folds and the number of CPUs.
+        model_kwargs: Keyword arguments passed to 'deep_nn_model', plots are not shown in the workers.
+
+    Returns:
+        models_list: A list of the folds models, each with a 'Fold' number, check 'deep_nn_model' output for details.
+        cv_summary: A dictionary of the models hyperparameters with the mean and standard deviation of the folds train and test accuracies.
+    '''
+    model_kwargs['show_plots'] = False
+    if n_jobs is None:
+        n_jobs = min(len(splits), cpu_count())
+
+    shm = shared_memory.SharedMemory(create = True, size = X.nbytes) # one copy of X shared by all the workers.
+    X_shared = np.ndarray(X.shape, dtype = X.dtype, buffer = shm.buf)
+    try:
+        X_shared[:] = X
+        tasks = [(shm.name, X.shape, X.dtype, Y, fold, train_indices, test_indices, model_kwargs)
+                 for fold, (train_indices, test_indices) in enumerate(splits)]
+        # The spawned workers load BLAS with the environment of the parent, a forked worker would keep the threads of the parent BLAS.
+        blas_threads = {name: environ.get(name) for name in BLAS_THREADS_VARIABLES}
+        environ.update({name: str(max(1, cpu_count() // n_jobs)) for name in BLAS_THREADS_VARIABLES})
+        try:
+            with ProcessPoolExecutor(max_workers = n_jobs, mp_context = get_context('spawn')) as executor:
+                models_list = list(executor.map(_cross_validation_fold, tasks))
+        finally:
+            for name, value in blas_threads.items(): # restoring the environment of the parent.
+                if value is None:
+                    environ.pop(name)
+                else:
+                    environ[name] = value
+    finally:
+        del X_shared
+        shm.close()
+        shm.unlink()
+
+    train_accs = np.array([model['Train Accuracy'] for model in models_list])
+    test_accs = np.array([model['Test Accuracy'] for model in models_list])
+
+    cv_summary = {key: value for key, value in models_list[0].items() if key not in ('P', 'Costs', 'Dropout Masks', 'Adam V', 'Adam S', 'Fold')}
+    cv_summary.update({'Model No.': str(datetime.now()), 'Folds': len(models_list),
+                       'Training Time': str(sum((pd.Timedelta(model['Training Time']) for model in models_list), pd.Timedelta(0))),
+                       'Train Accuracy': train_accs.mean().round(4), 'Test Accuracy': test_accs.mean().round(4),
+                       'Train Accuracy Std': train_accs.std().round(4), 'Test Accuracy Std': test_accs.std().round(4)})
+
+    print('Folds Test Accuracies:', test_accs.tolist())
+    print('Mean Test Accuracy: {}%'.format(cv_summary['Test Accuracy']))
+
+    return models_list, cv_summary
+
 
 # 28 ________________________________________________________________________________________________________________________________________________________________
 
+def store_models(models_list, store_path):
+    '''
+    Given a list of models resulting from the 'logistic_nn_model' or 'deep_nn_model' functions, the function adds them to an experiment store. The scalar
+    information of every model is written as a row of the 'models' table of an SQLite database, and its arrays (parameters, costs, masks...etc.) to separate
+    '.npy' files to be loaded only on demand by the 'load_model' function. Tuples (shapes, structures, layers) are written as JSON lists and other values as
+    text, with thier type recorded in the 'value_types' table so 'load_model' converts back only the values that were tuples.
+
+    Arguments:
+        models_list: A list of models outputed by either 'logistic_nn_model' or 'deep_nn_model' functions.
+        store_path: A path of the store directory, created if it does not exist.
+
+    Returns:
+        run_ids: A list of the run id given to every model in the store.
+    '''
+    makedirs(store_path, exist_ok = True)
+    connection = sqlite3.connect(path.join(store_path, 'models.db'))
+    run_ids = list()
+
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS models (run_id INTEGER PRIMARY KEY AUTOINCREMENT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS arrays (run_id INTEGER, key TEXT, name TEXT, file TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS value_types (run_id INTEGER, key TEXT, type TEXT)') # the values that are not kept as they are.
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(models)')}
+
+        for model in models_list:
+            scalars = dict() # values to be written to the table.
+            arrays = dict() # values to be written to files, as dictionaries of arrays.
+            value_types = dict() # the type of the values converted to be written to the table.
+            for key, value in model.items():
+                if isinstance(value, dict):
+                    arrays[key] = value
+                elif isinstance(value, (list, np.ndarray)):
+                    arrays[key] = {None: value}
+                elif isinstance(value, np.generic):
+                    scalars[key] = value.item()
+                elif isinstance(value, (bool, int, float, str)):
+                    scalars[key] = value
+                elif value is None: # to tell it from the empty columns of other models.
+                    scalars[key] = value
+                    value_types[key] = 'null'
+                elif isinstance(value, tuple): # tuples of shapes, structures and layers.
+                    scalars[key] = json.dumps(value, default = lambda item: item.item()) # numpy integers are written as python ones.
+                    value_types[key] = 'tuple'
+                else: # any other value is kept as text.
+                    scalars[key] = str(value)
+                    value_types[key] = 'text'
+
+            for key in scalars:
+                if key not in columns: # new keys are added as new columns.
+                    connection.execute('ALTER TABLE models ADD COLUMN "{}"'.format(key))
+                    columns.add(key)
+
+            cursor = connection.execute('INSERT INTO models ({}) VALUES ({})'.format(', '.join('"{}"'.format(key) for key in scalars),
+                                                                                     ', '.join('?' * len(scalars))), list(scalars.values()))
+            run_id = cursor.lastrowid
+            connection.executemany('INSERT INTO value_types VALUES (?, ?, ?)', [(run_id, key, value_type) for key, value_type in value_types.items()])
+            run_path = path.join(store_path, 'runs', str(run_id))
+            makedirs(run_path, exist_ok = True)
+
+            for key, value in arrays.items():
+                if len(value) == 0: # empty dictionaries (e.g. no dropout masks) are recorded without a file.
+                    connection.execute('INSERT INTO arrays VALUES (?, ?, ?, ?)', (run_id, key, None, None))
+                for name, array in value.items():
+                    file = key.replace(' ', '_').replace('.', '') + ('' if name is None else '_' + name) + '.npy'
+                    np.save(path.join(run_path, file), np.asarray(array))
+                    connection.execute('INSERT INTO arrays VALUES (?, ?, ?, ?)', (run_id, key, name, path.join('runs', str(run_id), file)))
+
+            run_ids.append(run_id)
+
+        if {'Test Accuracy', 'Train Accuracy'} <= columns: # to rank the models without scanning the table.
+            connection.execute('CREATE INDEX IF NOT EXISTS accuracy_index ON models ("Test Accuracy" DESC, "Train Accuracy" DESC)')
+
+    connection.close()
+    print('Stored models:', len(run_ids), 'in', store_path)
+
+    return run_ids
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def _connect_store(store_path):
+    '''
+    Returns a connection to the database of the experiment store at store_path, raising a FileNotFoundError if there is none (instead of creating it).
+    '''
+    database = path.join(store_path, 'models.db')
+    if not path.isfile(database):
+        raise FileNotFoundError('No experiment store found at {} (missing models.db), create one with the store_models function.'.format(store_path))
+
+    return sqlite3.connect(database)
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def _json_to_tuple(value):
+    '''
+    Converts the (nested) lists of a tuple written as JSON by 'store_models' back to tuples.
+    '''
+    if isinstance(value, list):
+        return tuple(_json_to_tuple(item) for item in value)
+
+    return value
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def store_summary(store_path, where = None, limit = None):
+    '''
+    The 'models_summary' function over an experiment store. Only the scalar information of the models is read, ranked by test then train accuracy.
+
+    Arguments:
+        store_path: A path of the store directory created by 'store_models' function.
+        where: An SQL condition to filter the models with, e.g. '"alpha" < 0.01 AND "Iterations" >= 1000', None by default for all models. Tuples are
+               written as JSON lists, e.g. '"Model Structure" = \'[12288, 5, 1]\''.
+        limit: An integer, the number of top models to return, None by default for all models.
+
+    Retunrs:
+        models_df: A pandas data frame of the ranked models, indexed by their run ids, empty if no model is found.
+        top_run_id: The run id of the model with the highest test accuracy then train accuracy, None if no model is found.
+    '''
+    query = 'SELECT * FROM models'
+    if where is not None:
+        query += ' WHERE ' + where
+    query += ' ORDER BY "Test Accuracy" DESC, "Train Accuracy" DESC'
+    if limit is not None:
+        query += ' LIMIT ' + str(int(limit))
+
+    connection = _connect_store(store_path)
+    columns = {row[1] for row in connection.execute('PRAGMA table_info(models)')}
+    if {'Test Accuracy', 'Train Accuracy'} <= columns:
+        models_df = pd.read_sql_query(query, connection, index_col = 'run_id')
+    else: # an empty store.
+        models_df = pd.DataFrame()
+    connection.close()
+
+    if models_df.empty:
+        print('No models found.')
+        return models_df, None
+
+    top_models = models_df[(models_df['Test Accuracy'] == models_df['Test Accuracy'].iloc[0]) &
+                           (models_df['Train Accuracy'] == models_df['Train Accuracy'].iloc[0])].index.tolist()
+    print('Top models, based on Test then Train accuracies:', top_models)
+
+    return models_df, top_models[0]
+
+# ________________________________________________________________________________________________________________________________________________________________
+
+def load_model(store_path, run_id, keys = None):
+    '''
+    Given a run id of an experiment store, the function returns the model as outputed by 'logistic_nn_model' or 'deep_nn_model' functions. The arrays are
+    memory mapped from thier files (read only), so they are only read from disk when used.
+
+    Arguments:
+        store_path: A path of the store directory created by 'store_models' function.
+        run_id: The run id of the model, as returned by 'store_models' or 'store_summary' functions.
+        keys: A list of the array keys to load, e.g. ['P'], None by default for all of them.
+
+    Returns:
+        model: A dictionary with the model information.
+    '''
+    connection = _connect_store(store_path)
+    cursor = connection.execute('SELECT * FROM models WHERE run_id = ?', (run_id,))
+    row = cursor.fetchone()
+    columns = [column[0] for column in cursor.description]
+    array_rows = connection.execute('SELECT key, name, file FROM arrays WHERE run_id = ?', (run_id,)).fetchall()
+    value_types = dict(connection.execute('SELECT key, type FROM value_types WHERE run_id = ?', (run_id,)).fetchall())
+    connection.close()
+    if row is None:
+        raise KeyError('Run id {} is not in the store {}.'.format(run_id, store_path))
+
+    model = dict()
+    for key, value in zip(columns[1:], row[1:]):
+        if value is None and value_types.get(key) != 'null': # a column added by other models.
+            continue
+        if value_types.get(key) == 'tuple':
+            value = _json_to_tuple(json.loads(value))
+        model[key] = value
+
+    for key, name, file in array_rows:
+        if keys is not None and key not in keys:
+            continue
+        if file is None: # an empty dictionary.
+            model[key] = dict()
+            continue
+        array = np.load(path.join(store_path, file), mmap_mode = 'r')
+        if name is None:
+            model[key] = array
+        else:
+            model.setdefault(key, dict())[name] = array
+
+    return model
+
 
 # 29 ________________________________________________________________________________________________________________________________________________________________
 